@@ -19,6 +19,12 @@ except ImportError:
 from git.exc import InvalidGitRepositoryError
 
 from git_sound.gitmidi import GitMIDI
+from git_sound.server import RenderCache, RenderServer
+from git_sound.shard import ShardError, merge_shards, render_shard, \
+    render_shards
+from git_sound.stream import EventStreamer, midi_events
+from git_sound.sweep import render_sweep
+from git_sound.watch import follow_branch
 
 SCALES = {
     'c-major': ('C Major', [60, 62, 64, 65, 67, 69, 71]),
@@ -113,6 +119,11 @@ parser.add_argument('--file',
                     type=str,
                     default=None,
                     help="Save the generated MIDI sequence to this file")
+parser.add_argument('--index',
+                    action='store_true',
+                    default=False,
+                    help="Save a commit time index next to the MIDI file " +
+                    "given with --file (with an .idx suffix)")
 parser.add_argument('--play',
                     action='store_true',
                     default=False,
@@ -141,9 +152,173 @@ parser.add_argument('--skip',
                     help="Skip the first N commits " +
                     "(comes in handy if the repo started " +
                     "with some huge commits)")
+parser.add_argument('--jobs',
+                    type=int,
+                    default=None,
+                    metavar='N',
+                    help="Encode the MIDI data in segments, using N " +
+                    "worker processes")
+parser.add_argument('--preview',
+                    type=int,
+                    default=None,
+                    metavar='N',
+                    help="Generate a short, low resolution preview by " +
+                    "grouping the commits into N buckets")
+parser.add_argument('--stream',
+                    type=str,
+                    default=None,
+                    metavar='ADDRESS',
+                    help="Stream the MIDI events in real time to a " +
+                    "datagram socket (udp:HOST:PORT or unix:PATH)")
+parser.add_argument('--watch',
+                    action='store_true',
+                    default=False,
+                    help="Follow the branch, and generate sound for new " +
+                    "commits as they arrive.  With --file, the file is " +
+                    "updated with every commit; with --play, the notes " +
+                    "of every commit are played")
+parser.add_argument('--serve',
+                    type=str,
+                    default=None,
+                    metavar='[HOST:]PORT',
+                    help="Start an HTTP server that renders repositories " +
+                    "on request")
+parser.add_argument('--serve-root',
+                    type=str,
+                    default=None,
+                    metavar='DIR',
+                    help="Only serve repositories under DIR")
+parser.add_argument('--cache-dir',
+                    type=str,
+                    default=None,
+                    metavar='DIR',
+                    help="Cache the tracks rendered by the server in DIR")
+parser.add_argument('--cache-size',
+                    type=int,
+                    default=1024,
+                    metavar='MB',
+                    help="Maximum size of the disk cache [1024]")
+parser.add_argument('--sweep',
+                    type=str,
+                    default=None,
+                    metavar='DIR',
+                    help="Render every given scale and program " +
+                    "combination into DIR.  --scale and --program " +
+                    "accept a comma separated list or all in this mode")
+parser.add_argument('--shard',
+                    type=str,
+                    default=None,
+                    metavar='[I/]N',
+                    help="Split the history into N shards, and only read " +
+                    "the commits of shard I (counting from 0) into " +
+                    "--shard-dir.  Without I, all shards are read " +
+                    "locally, using --jobs processes")
+parser.add_argument('--shard-by',
+                    type=str,
+                    choices=('count', 'date'),
+                    default='count',
+                    help="Split the history into shards with the same " +
+                    "number of commits, or covering the same time span " +
+                    "[count]")
+parser.add_argument('--shard-dir',
+                    type=str,
+                    default='shards',
+                    metavar='DIR',
+                    help="Directory of the shards' partial files [shards]")
+parser.add_argument('--merge',
+                    type=str,
+                    default=None,
+                    metavar='DIR',
+                    help="Generate the track from the partial files in " +
+                    "DIR instead of reading the repository")
 
 args = parser.parse_args()
 
+if args.index and not args.file:
+    print("--index needs --file, as the index is saved next to it")
+
+    sys.exit(1)
+
+if args.serve:
+    host, _, port = args.serve.rpartition(':')
+    cache = RenderCache(directory=args.cache_dir,
+                        max_disk=args.cache_size * 1024 * 1024)
+    server = RenderServer((host or '127.0.0.1', int(port)),
+                          dict((scale_id, scale[1])
+                               for scale_id, scale in SCALES.items()),
+                          PROGRAMS,
+                          cache=cache,
+                          root=args.serve_root,
+                          verbose=args.verbose)
+
+    if args.verbose:
+        print("Listening on {}:{}".format(*server.server_address))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    sys.exit(0)
+
+if args.watch and args.preview:
+    print("--preview can't be used with --watch")
+
+    sys.exit(1)
+
+if args.merge and (args.preview or args.skip):
+    print("--preview and --skip can't be used with --merge; " +
+          "use --skip when rendering the shards instead")
+
+    sys.exit(1)
+
+if args.shard:
+    shard, _, shards = args.shard.rpartition('/')
+
+    try:
+        if int(shards) < 1:
+            raise ValueError("Invalid number of shards")
+
+        if shard:
+            filenames = [render_shard(args.repository,
+                                      int(shard),
+                                      int(shards),
+                                      args.shard_dir,
+                                      branch=args.branch,
+                                      by=args.shard_by,
+                                      skip=args.skip,
+                                      verbose=args.verbose)]
+        else:
+            filenames = render_shards(args.repository,
+                                      int(shards),
+                                      args.shard_dir,
+                                      branch=args.branch,
+                                      by=args.shard_by,
+                                      skip=args.skip,
+                                      jobs=args.jobs,
+                                      verbose=args.verbose)
+    except ValueError:
+        print("Invalid shard: {}".format(args.shard))
+
+        sys.exit(1)
+
+    except InvalidGitRepositoryError:
+        print("{} is not a valid Git repository"
+              .format(os.path.abspath(args.repository)))
+
+        sys.exit(1)
+
+    except IndexError:
+        print("Branch '{}' does not exist in this repo".format(args.branch))
+
+        sys.exit(1)
+
+    if args.verbose:
+        for filename in filenames:
+            print("Saved {}".format(filename))
+
+    sys.exit(0)
+
 if args.scale is None and args.program is None and GUI_AVAILABLE:
     GitSoundWindow(PROGRAMS, SCALES).start()
 
@@ -171,6 +346,60 @@ if args.program == 'list':
 
     sys.exit(0)
 
+if args.sweep:
+    if args.scale == 'all':
+        scale_ids = list(SCALES.keys())
+    else:
+        scale_ids = args.scale.split(',')
+
+    if args.program == 'all':
+        program_ids = list(PROGRAMS.keys())
+    else:
+        program_ids = args.program.split(',')
+
+    for scale_id in scale_ids:
+        if scale_id not in SCALES:
+            print("{} is an unknown scale.".format(scale_id))
+            print("Use 'list' to list the available scales.")
+
+            sys.exit(1)
+
+    for program_id in program_ids:
+        if program_id not in PROGRAMS:
+            print("{} is an unknown program.".format(program_id))
+            print("Use 'list' to list the available programs.")
+
+            sys.exit(1)
+
+    try:
+        filenames = render_sweep(
+            args.repository,
+            dict((scale_id, SCALES[scale_id][1]) for scale_id in scale_ids),
+            dict((program_id, PROGRAMS[program_id])
+                 for program_id in program_ids),
+            args.sweep,
+            branch=args.branch,
+            verbose=args.verbose,
+            volume_range=args.volume_range,
+            skip=args.skip,
+            jobs=args.jobs)
+    except InvalidGitRepositoryError:
+        print("{} is not a valid Git repository"
+              .format(os.path.abspath(args.repository)))
+
+        sys.exit(1)
+
+    except IndexError:
+        print("Branch '{}' does not exist in this repo".format(args.branch))
+
+        sys.exit(1)
+
+    if args.verbose:
+        for filename in sorted(filenames.values()):
+            print("Saved {}".format(filename))
+
+    sys.exit(0)
+
 if args.scale not in SCALES:
     print("{} is an unknown scale.".format(args.scale))
     print("Use 'list' to list the available scales.")
@@ -184,13 +413,26 @@ if args.program not in PROGRAMS:
     sys.exit(1)
 
 try:
-    repo_midi = GitMIDI(repository=args.repository,
-                        branch=args.branch,
-                        verbose=args.verbose,
-                        scale=SCALES[args.scale][1],
-                        program=PROGRAMS[args.program],
-                        volume_range=args.volume_range,
-                        skip=args.skip)
+    if args.merge:
+        repo_midi = merge_shards(args.merge,
+                                 verbose=args.verbose,
+                                 scale=SCALES[args.scale][1],
+                                 program=PROGRAMS[args.program],
+                                 volume_range=args.volume_range)
+    else:
+        repo_midi = GitMIDI(repository=args.repository,
+                            branch=args.branch,
+                            verbose=args.verbose,
+                            scale=SCALES[args.scale][1],
+                            program=PROGRAMS[args.program],
+                            volume_range=args.volume_range,
+                            skip=args.skip,
+                            preview=args.preview)
+
+except ShardError as error:
+    print(error)
+
+    sys.exit(1)
 
 except InvalidGitRepositoryError:
     print("{} is not a valid Git repository"
@@ -203,9 +445,82 @@ except IndexError:
 
     sys.exit(1)
 
+if args.watch:
+    watched_midi = None
+
+    if args.file:
+        # The file starts with the current history of the branch, and
+        # new commits are appended to it
+        repo_midi.gen_repo_data()
+        watched_midi = GitMIDI(scale=SCALES[args.scale][1],
+                               program=PROGRAMS[args.program],
+                               volume_range=args.volume_range,
+                               records=list(repo_midi.records))
+
+    def play_beat(beat, record):
+        """
+        Print, play and/or save the notes of a new commit.
+        """
+
+        print("{} {} {}".format(beat['sha'][:7],
+                                beat['commit_note'],
+                                ' '.join(str(file_note['note'])
+                                         for file_note in beat['file_notes'])))
+
+        if args.play:
+            beat_midi = GitMIDI(scale=SCALES[args.scale][1],
+                                program=PROGRAMS[args.program],
+                                volume_range=args.volume_range,
+                                records=[record])
+            beat_midi.write_mem(jobs=1)
+            play_beat.midi = beat_midi
+            beat_midi.play(track=True)
+
+        if watched_midi is not None:
+            watched_midi.append_records([record])
+            save_watched()
+
+    def rewind(shas):
+        """
+        Remove commits that are no longer on the branch.
+        """
+
+        if args.verbose:
+            print("{} commits removed from the branch".format(len(shas)))
+
+        if watched_midi is not None:
+            watched_midi.drop_records(shas)
+            save_watched()
+
+    def save_watched():
+        """
+        Save the history of the branch, including the new commits.
+        """
+
+        watched_midi.write_mem(jobs=args.jobs)
+        watched_midi.export_file(args.file)
+
+        if args.index:
+            watched_midi.export_index(args.file + '.idx')
+
+    if watched_midi is not None:
+        save_watched()
+
+    if args.verbose:
+        print("Watching {}…".format(args.branch))
+
+    try:
+        follow_branch(repo_midi, args.repository, args.branch,
+                      play_beat, on_rewind=rewind,
+                      head=repo_midi.branch_head)
+    except KeyboardInterrupt:
+        pass
+
+    sys.exit(0)
+
 repo_midi.gen_repo_data()
 repo_midi.generate_midi()
-repo_midi.write_mem()
+repo_midi.write_mem(jobs=args.jobs)
 
 if args.file:
     if args.verbose:
@@ -213,5 +528,41 @@ if args.file:
 
     repo_midi.export_file(args.file)
 
+    if args.index:
+        repo_midi.export_index(args.file + '.idx')
+
+if args.stream:
+    # Prepare the events before starting playback, so the stream can
+    # start together with it
+    stream_events = midi_events(repo_midi)
+
 if args.play:
-    repo_midi.play()
+    # When streaming, don’t wait for the end of the track, so the events
+    # are sent while it plays
+    repo_midi.play(track=args.stream is not None)
+
+if args.stream:
+    if args.verbose:
+        print("Streaming to {}".format(args.stream))
+
+    streamer = EventStreamer(args.stream)
+
+    try:
+        streamer.stream(repo_midi, events=stream_events)
+    except KeyboardInterrupt:
+        if args.play:
+            repo_midi.stop()
+    except (IOError, OSError) as error:
+        print("Cannot stream to {}: {}".format(args.stream,
+                                               error.strerror or error))
+
+        if args.play:
+            repo_midi.stop()
+
+        sys.exit(1)
+    finally:
+        streamer.close()
+
+    if args.verbose and streamer.dropped:
+        print("{} datagrams dropped, the receiver was too slow"
+              .format(streamer.dropped))
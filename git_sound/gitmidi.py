@@ -5,16 +5,20 @@ The GitMIDI class that converts a Git repository’s log into MIDI music.
 
 from __future__ import print_function
 
+import copy
 import os
 import shutil
 from time import sleep
 
 from io import BytesIO
 
-from midiutil.MidiFile import MIDIFile
+from midiutil.MidiFile import MIDIFile, TICKSPERBEAT
 from git import Repo, Tree
 from git.objects.blob import Blob
 
+from .encoder import write_segmented
+from .timeindex import TimeIndex
+
 try:
     import pygame
     import pygame.mixer
@@ -47,6 +51,50 @@ def get_file_sha(commit, file_name):
     return tree.hexsha
 
 
+def commit_record(commit):
+    """
+    Read the data of a commit needed for beat generation.  The result
+    only contains plain Python types.
+    """
+
+    stat = commit.stats
+
+    record = {
+        'sha': commit.hexsha,
+        'date': commit.authored_date,
+        'insertions': stat.total['insertions'],
+        'deletions': stat.total['deletions'],
+        'files': [],
+    }
+
+    for file_name, file_stat in stat.files.items():
+        record['files'].append({
+            'name': file_name,
+            'sha': get_file_sha(commit, file_name),
+            'insertions': file_stat['insertions'],
+            'deletions': file_stat['deletions'],
+        })
+
+    return record
+
+
+def date_position(items, item):
+    """
+    Get the position to insert item (a commit record or a beat) into a
+    list of items sorted by date and SHA1 ID.  Searches from the end,
+    as new commits usually belong there.
+    """
+
+    key = (item['date'], item['sha'])
+    position = len(items)
+
+    while position > 0 and \
+            (items[position - 1]['date'], items[position - 1]['sha']) > key:
+        position -= 1
+
+    return position
+
+
 class GitMIDI(MIDIFile):
     """
     Class to hold repository data, and MIDI data based on that repository.
@@ -55,6 +103,10 @@ class GitMIDI(MIDIFile):
     LOG_CHANNEL = 0
     FILE_CHANNEL = 1
 
+    # The generation pipeline, in order.  Each stage is only rerun if a
+    # parameter it (or a stage before it) depends on has changed.
+    STAGES = ('ingest', 'mapping', 'events', 'encoding')
+
     def __setup_midi(self, track_title=None):
         """
         Initialise the MIDI file.
@@ -85,8 +137,12 @@ class GitMIDI(MIDIFile):
         if self.__verbose:
             print("Analyzing repository…")
 
-        repo = Repo(self.__repo_dir)
-        self.__branch_head = repo.heads[self.__branch].commit
+        self.__repo = Repo(self.__repo_dir)
+
+        if self.__head is not None:
+            self.__branch_head = self.__repo.commit(self.__head)
+        else:
+            self.__branch_head = self.__repo.heads[self.__branch].commit
 
     def __init__(self,
                  repository=None,
@@ -98,23 +154,83 @@ class GitMIDI(MIDIFile):
                  skip=None,
                  note_duration=None,
                  max_beat_len=None,
-                 tempo=None):
+                 tempo=None,
+                 records=None,
+                 preview=None,
+                 preview_by=None,
+                 preview_length=None,
+                 head=None):
+        """
+        If records is set, it must be a list of commit records (as
+        returned by read_commit()), sorted by date.  Those are used
+        instead of reading the repository.
+
+        If preview is set, a low resolution preview is rendered instead
+        of the full history: commits are grouped into that many buckets
+        (by commit count, or by date if preview_by is 'date'), and only
+        one sampled commit is read from each bucket.  The preview track
+        is preview_length seconds long (20 by default).
+
+        If head (a SHA1 ID) is set, the history up to that commit is
+        rendered instead of the history of branch, and refresh() never
+        changes it.
+        """
+
         MIDIFile.__init__(self, 1)
 
         self.__verbose = verbose or False
-        self.__written = False
         self.__repo_dir = repository or '.'
         self.__repo = None
         self.__branch = branch or 'master'
         self.__branch_head = None
+        self.__head = head
         self.__repo_data = None
+        self.__repo_data_head = None
+        self.__commit_data = {}
+        self.__given_records = records
+        self.__records_revision = 0
+        self.__preview = preview
+        self.__preview_by = preview_by or 'count'
+        self.__preview_length = preview_length or 20
+        self.__records = []
         self.__git_log = []
+        self.__time_index = None
+        self.__stage_keys = {}
         self.__mem_file = BytesIO()
-        self.__scale = scale
-        self.__program = program
-        self.__volume_deviation = min(abs(63 - (volume_range or 107)), 63)
         self.__pygame_inited = False
         self.__playing = False
+
+        self.configure(scale=scale,
+                       program=program,
+                       volume_range=volume_range,
+                       skip=skip,
+                       note_duration=note_duration,
+                       max_beat_len=max_beat_len,
+                       tempo=tempo)
+
+        if records is None:
+            self.__setup_repo()
+
+    def configure(self,
+                  scale=None,
+                  program=None,
+                  volume_range=None,
+                  skip=None,
+                  note_duration=None,
+                  max_beat_len=None,
+                  tempo=None):
+        """
+        Change the generation parameters.  The parameters have the same
+        meaning and defaults as for the constructor.
+
+        Nothing is regenerated here; the next call to gen_repo_data(),
+        generate_midi() or write_mem() only reruns the stages that
+        depend on a changed parameter.
+        """
+
+        self.__scale = scale
+        self.__program = copy.deepcopy(program)
+        self.__volume_deviation = min(abs(63 - (volume_range or 107)), 63)
         self.__skip = skip or 0
         self.__note_duration = note_duration or 0.3
         self.__max_beat_len = max_beat_len
@@ -123,8 +239,57 @@ class GitMIDI(MIDIFile):
         self.__need_commits = self.__program['commit']['program'] is not None
         self.__need_files = self.__program['file']['program'] is not None
 
-        self.__setup_midi()
-        self.__setup_repo()
+    def __stage_params(self, stage):
+        """
+        Get the parameters a single pipeline stage depends on.
+        """
+
+        if stage == 'ingest':
+            if self.__branch_head is None:
+                return (None, self.__skip, self.__records_revision)
+
+            return (self.__branch_head.hexsha,
+                    self.__skip,
+                    self.__preview,
+                    self.__preview_by)
+
+        if stage == 'mapping':
+            return (tuple(self.__scale),
+                    self.__program,
+                    self.__volume_deviation,
+                    self.__max_beat_len)
+
+        if stage == 'events':
+            return (self.__note_duration,
+                    self.__tempo,
+                    self.__preview and self.__preview_length)
+
+        return ()
+
+    def stage_key(self, stage):
+        """
+        Get the cache key of a pipeline stage.  It contains the
+        parameters of the stage and of all the stages before it.
+        """
+
+        index = self.STAGES.index(stage)
+
+        return tuple(self.__stage_params(prev_stage)
+                     for prev_stage in self.STAGES[:index + 1])
+
+    def is_stale(self, stage):
+        """
+        Check if a pipeline stage has to be (re)run.
+        """
+
+        return self.__stage_keys.get(stage) != self.stage_key(stage)
+
+    def __stage_done(self, stage):
+        """
+        Mark a pipeline stage as up to date.
+        """
+
+        self.__stage_keys[stage] = self.stage_key(stage)
 
     def gen_volume(self, deletions, insertions, modifier):
         """
@@ -149,17 +314,30 @@ class GitMIDI(MIDIFile):
 
         return self.__scale[note_num]
 
-    def gen_beat(self, commit):
+    def read_commit(self, commit):
         """
-        Generate data for a beat based on a commit and its files.
+        Read the data of a commit needed for beat generation (see
+        commit_record()).  Records are cached by SHA1 ID.
         """
 
-        stat = commit.stats
+        if commit.hexsha in self.__commit_data:
+            return self.__commit_data[commit.hexsha]
+
+        record = commit_record(commit)
+        self.__commit_data[commit.hexsha] = record
+
+        return record
+
+    def gen_beat(self, record):
+        """
+        Generate data for a beat based on a commit record (as returned
+        by read_commit()).
+        """
 
         file_notes = []
         file_count = 0
 
-        for file_name, file_stat in stat.files.items():
+        for file_record in record['files']:
             file_count += 1
 
             if self.__max_beat_len is not None and \
@@ -168,10 +346,10 @@ class GitMIDI(MIDIFile):
                 break
 
             volume_mod = self.__program['file'].get('volume', 0)
-            file_note = self.sha_to_note(get_file_sha(commit, file_name)) + \
+            file_note = self.sha_to_note(file_record['sha']) + \
                         self.__program['file']['octave'] * 12
-            file_volume = self.gen_volume(file_stat['deletions'],
-                                          file_stat['insertions'],
+            file_volume = self.gen_volume(file_record['deletions'],
+                                          file_record['insertions'],
                                           volume_mod)
 
             file_notes.append({
@@ -181,32 +359,31 @@ class GitMIDI(MIDIFile):
 
         volume_mod = self.__program['commit'].get('volume', 0)
 
-        commit_note = self.sha_to_note(commit.hexsha) + \
+        commit_note = self.sha_to_note(record['sha']) + \
                       self.__program['commit']['octave'] * 12
-        commit_volume = self.gen_volume(stat.total['deletions'],
-                                        stat.total['insertions'],
+        commit_volume = self.gen_volume(record['deletions'],
+                                        record['insertions'],
                                         volume_mod)
 
         return {
+            'sha': record['sha'],
+            'date': record['date'],
             'commit_note': commit_note,
             'commit_volume': commit_volume,
             'file_notes': file_notes,
         }
 
-    def gen_repo_data(self, force=False, callback=None):
+    def __read_history(self, callback=None):
         """
-        Populate __repo_data with the Git history data. If force is
-        False and the repo_data is already calculated, we do not do
-        anything.
+        Walk the history of the branch, and populate __repo_data with
+        its commits, sorted by authoring date.
         """
 
-        if self.__repo_data and not force:
-            return
-
         if self.__verbose:
             print("Reading repository log…")
 
         self.__repo_data = []
+        seen = set()
         counter = 0
         to_process = [self.__branch_head]
 
@@ -222,7 +399,8 @@ class GitMIDI(MIDIFile):
             if callback is not None:
                 callback(None, None)
 
-            if current_commit not in self.__repo_data:
+            if current_commit.hexsha not in seen:
+                seen.add(current_commit.hexsha)
                 self.__repo_data.append(current_commit)
                 to_process += current_commit.parents
 
@@ -230,12 +408,91 @@ class GitMIDI(MIDIFile):
             print("{} commits found".format(counter))
             print("Sorting commits…")
 
-        self.__repo_data.sort(key=lambda commit: commit.authored_date)
+        # Sort commits with the same date by SHA1 ID, so the order does
+        # not depend on the walk (sharded renders list them the same way)
+        self.__repo_data.sort(key=lambda commit: (commit.authored_date,
+                                                  commit.hexsha))
+        self.__repo_data_head = self.__branch_head.hexsha
+
+    def __bucket_history(self, entries):
+        """
+        Split the (timestamp, SHA) pairs of the history into preview
+        buckets.
+        """
+
+        count = len(entries)
+
+        if self.__preview_by == 'date' and count > 0:
+            first = entries[0][0]
+            width = float(entries[-1][0] - first) / self.__preview or 1
+            buckets = [[] for _ in range(self.__preview)]
+
+            for entry in entries:
+                index = min(int((entry[0] - first) / width),
+                            self.__preview - 1)
+                buckets[index].append(entry)
+
+            return [bucket for bucket in buckets if bucket]
+
+        return [entries[i * count // self.__preview:
+                        (i + 1) * count // self.__preview]
+                for i in range(self.__preview)
+                if (i + 1) * count // self.__preview >
+                i * count // self.__preview]
+
+    def __sample_history(self, callback=None):
+        """
+        Preview ingest stage: list the history of the branch without
+        loading the commits, and read only one commit per bucket.
+        """
 
         if self.__verbose:
-            print("Generating MIDI data…")
+            print("Sampling repository log…")
 
-        self.__git_log = []
+        if callback is not None:
+            callback(None, None)
+
+        log = self.__repo.git.log('--format=%at %H',
+                                  self.__branch_head.hexsha)
+        entries = sorted((int(timestamp), sha)
+                         for timestamp, sha in (line.split()
+                                                for line in log.splitlines()))
+        buckets = self.__bucket_history(entries[self.__skip:])
+
+        self.__records = []
+        bucket_count = len(buckets)
+
+        for current, bucket in enumerate(buckets, 1):
+            if callback is not None:
+                callback(bucket_count, current)
+
+            sample = bucket[len(bucket) // 2][1]
+            self.__records.append(
+                self.read_commit(self.__repo.commit(sample)))
+
+    def __ingest(self, callback=None):
+        """
+        Ingest stage: read the history and the per-commit data of the
+        branch.
+        """
+
+        if self.__given_records is not None:
+            self.__records = self.__given_records[self.__skip:]
+
+            return
+
+        if self.__preview:
+            self.__sample_history(callback=callback)
+
+            return
+
+        if self.__repo_data_head != self.__branch_head.hexsha:
+            self.__read_history(callback=callback)
+
+        if self.__verbose:
+            print("Reading commit data…")
+
+        self.__records = []
         current_commit = 0
         commits_to_process = self.__repo_data[self.__skip:]
         commit_count = len(commits_to_process)
@@ -249,7 +506,121 @@ class GitMIDI(MIDIFile):
             if self.__verbose:
                 print("{}/{}".format(current_commit, commit_count))
 
-            self.__git_log.append(self.gen_beat(commit))
+            self.__records.append(self.read_commit(commit))
+
+    def __map_notes(self, callback=None):
+        """
+        Note mapping stage: convert commit records to beats.
+        """
+
+        if self.__verbose:
+            print("Generating MIDI data…")
+
+        self.__git_log = []
+        record_count = len(self.__records)
+
+        for current, record in enumerate(self.__records, 1):
+            if callback:
+                callback(record_count, current)
+
+            self.__git_log.append(self.gen_beat(record))
+
+    def refresh(self):
+        """
+        Read the head of the branch again, so the next generation picks
+        up new commits.  Returns True if the head has moved.
+
+        The head is only read here, on construction and when forcing a
+        regeneration, so accessors like midi_data never switch to a
+        newer history behind the caller’s back.
+        """
+
+        if self.__repo is None or self.__head is not None:
+            return False
+
+        old_head = self.__branch_head
+        self.__branch_head = self.__repo.heads[self.__branch].commit
+
+        return old_head != self.__branch_head
+
+    def gen_repo_data(self, force=False, callback=None):
+        """
+        Populate __repo_data with the Git history data, and generate
+        beat data from it.  Stages that are already up to date are not
+        run again, unless force is True; in that case the head of the
+        branch is read again, too (see refresh()).
+        """
+
+        if force:
+            self.__stage_keys = {}
+            self.__commit_data = {}
+            self.__repo_data_head = None
+            self.refresh()
+
+        if self.is_stale('ingest'):
+            self.__ingest(callback=callback)
+            self.__stage_done('ingest')
+
+        if self.is_stale('mapping'):
+            self.__map_notes(callback=callback)
+            self.__stage_done('mapping')
+
+    def append_records(self, records):
+        """
+        Add commit records to a track generated from commit records.
+        Records are inserted by date (and SHA1 ID), so a commit older
+        than the end of the track, like one from a merged branch, is
+        put in its place.  Only the beats of the new records are
+        generated; the events and encoding stages run again on the next
+        write.
+        """
+
+        if self.__given_records is None:
+            raise ValueError("The track is not generated from records")
+
+        self.gen_repo_data()
+
+        self.__given_records = list(self.__given_records)
+
+        for record in records:
+            self.__given_records.insert(
+                date_position(self.__given_records, record), record)
+
+            position = date_position(self.__records, record)
+            self.__records.insert(position, record)
+            self.__git_log.insert(position, self.gen_beat(record))
+
+        self.__records_changed()
+
+    def drop_records(self, shas):
+        """
+        Remove the commits with the given SHA1 IDs from a track
+        generated from commit records.
+        """
+
+        if self.__given_records is None:
+            raise ValueError("The track is not generated from records")
+
+        self.gen_repo_data()
+
+        shas = set(shas)
+        self.__given_records = [record for record in self.__given_records
+                                if record['sha'] not in shas]
+        self.__records = [record for record in self.__records
+                          if record['sha'] not in shas]
+        self.__git_log = [beat for beat in self.__git_log
+                          if beat['sha'] not in shas]
+        self.__records_changed()
+
+    def __records_changed(self):
+        """
+        Mark the ingest and mapping stages as updated in place after
+        changing the records, so only the later stages run again.
+        """
+
+        self.__records_revision += 1
+        self.__stage_done('ingest')
+        self.__stage_done('mapping')
 
     @property
     def repo_data(self):
@@ -262,67 +633,227 @@ class GitMIDI(MIDIFile):
 
         return self.__repo_data
 
-    def write_mem(self):
+    @property
+    def records(self):
+        """
+        Get the commit records read by the ingest stage.
+        """
+
+        return self.__records
+
+    @property
+    def git_log(self):
+        """
+        Get the generated beat data.
+        """
+
+        return self.__git_log
+
+    def write_mem(self, jobs=None):
         """
         Write MIDI data to the memory file.
+
+        The tracks are encoded in time segments (see write_segmented()),
+        which avoids the quadratic byte concatenation of MIDIUtil’s
+        writeFile().  If jobs is greater than 1, the segments are
+        encoded by that many worker processes.
         """
 
-        self.writeFile(self.__mem_file)
-        self.__written = True
+        self.generate_midi()
+
+        if not self.is_stale('encoding'):
+            return
+
+        self.__mem_file = BytesIO()
+
+        write_segmented(self, self.__mem_file, jobs=jobs)
+
+        self.__stage_done('encoding')
 
     def export_file(self, filename):
         """
         Export MIDI data to a file.
         """
 
-        if not self.__written:
-            self.write_mem()
+        self.write_mem()
 
         with open(filename, 'wb') as midi_file:
             self.__mem_file.seek(0)
             midi_file.write(self.__mem_file.getbuffer())
 
-    def generate_midi(self, callback=None):
+    @property
+    def midi_data(self):
         """
-        Generate MIDI data.
+        Get the encoded MIDI data.
         """
 
-        if self.__verbose:
-            print("Creating MIDI…")
+        self.write_mem()
+
+        return self.__mem_file.getvalue()
+
+    @property
+    def branch_head(self):
+        """
+        Get the SHA1 ID of the branch head the track is generated from,
+        or None if the track is generated from commit records.
+        """
+
+        if self.__branch_head is None:
+            return None
+
+        return self.__branch_head.hexsha
+
+    def __get_note_duration(self):
+        """
+        Get the length of file notes, in beats.  For previews, it is
+        calculated so the track is exactly preview_length seconds long.
+        """
+
+        if not self.__preview:
+            return self.__note_duration
+
+        file_notes = sum(len(section['file_notes'])
+                         for section in self.__git_log)
+
+        return float(self.__preview_length) * self.__tempo / 60 / \
+            max(file_notes, 1)
+
+    def __iter_sections(self, callback=None, progress=True):
+        """
+        Generate the sections of the track (one for each beat), as
+        (section, time, section length, note duration) tuples.  Time and
+        lengths are in beats.  If progress is False, progress is not
+        reported.
+        """
 
-        track = 0
         time = 0
-        log_channel = 0
-        decor_channel = 1
+        note_duration = self.__get_note_duration()
 
         log_length = len(self.__git_log)
         current = 0
 
-        # WRITE THE SEQUENCE
         for section in self.__git_log:
             current += 1
-            section_len = len(section['file_notes']) * self.__note_duration
+            section_len = len(section['file_notes']) * note_duration
 
-            if callback is not None:
+            if progress and callback is not None:
                 callback(log_length, current)
 
-            if self.__verbose:
+            if progress and self.__verbose:
                 print("{}/{}".format(current, log_length))
 
+            yield section, time, section_len, note_duration
+
+            time += section_len
+
+    def iter_notes(self, callback=None, progress=True):
+        """
+        Generate the notes of the track from the beat data, as
+        (channel, pitch, time, duration, volume) tuples.  Time and
+        duration are in beats.  If progress is False, progress is not
+        reported.
+        """
+
+        for section, time, section_len, note_duration in \
+                self.__iter_sections(callback=callback, progress=progress):
             # Add a long note
             if self.__need_commits:
-                self.addNote(track, log_channel,
-                             section['commit_note'], time,
-                             section_len, section['commit_volume'])
+                yield (self.LOG_CHANNEL, section['commit_note'], time,
+                       section_len, section['commit_volume'])
 
             if self.__need_files:
                 for i, file_note in enumerate(section['file_notes']):
-                    self.addNote(track, decor_channel,
-                                 file_note['note'],
-                                 time + i * self.__note_duration,
-                                 self.__note_duration, file_note['volume'])
+                    yield (self.FILE_CHANNEL, file_note['note'],
+                           time + i * note_duration,
+                           note_duration, file_note['volume'])
 
-            time += section_len
+    def __build_time_index(self):
+        """
+        Build the index of commits by their start time in the track.
+        """
+
+        entries = []
+        file_note = 0
+
+        for section, time, _, _ in self.__iter_sections(progress=False):
+            file_count = len(section['file_notes'])
+            entries.append((int(round(time * TICKSPERBEAT)),
+                            section['date'],
+                            section['sha'],
+                            file_note,
+                            file_count))
+            file_note += file_count
+
+        self.__time_index = TimeIndex(entries, self.__tempo)
+
+    @property
+    def time_index(self):
+        """
+        Get the index of commits by their position in the track (see
+        TimeIndex).
+        """
+
+        self.generate_midi()
+
+        return self.__time_index
+
+    def export_index(self, filename):
+        """
+        Export the time index to a file.
+        """
+
+        self.time_index.save(filename)
+
+    @property
+    def tempo(self):
+        """
+        Get the tempo of the track, in beats per minute.
+        """
+
+        return self.__tempo
+
+    @property
+    def channel_programs(self):
+        """
+        Get the MIDI programs of the used channels, as a dictionary.
+        """
+
+        programs = {}
+
+        if self.__need_commits:
+            programs[self.LOG_CHANNEL] = self.__program['commit']['program']
+
+        if self.__need_files:
+            programs[self.FILE_CHANNEL] = self.__program['file']['program']
+
+        return programs
+
+    def generate_midi(self, callback=None):
+        """
+        Generate MIDI data.
+        """
+
+        self.gen_repo_data(callback=callback)
+
+        if not self.is_stale('events'):
+            return
+
+        if self.__verbose:
+            print("Creating MIDI…")
+
+        # Start over with an empty MIDI file
+        MIDIFile.__init__(self, 1)
+        self.__setup_midi()
+
+        track = 0
+
+        # WRITE THE SEQUENCE
+        for channel, pitch, time, duration, volume in \
+                self.iter_notes(callback=callback):
+            self.addNote(track, channel, pitch, time, duration, volume)
+
+        self.__build_time_index()
+        self.__stage_done('events')
 
     def __init_pygame(self):
         """
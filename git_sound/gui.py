@@ -4,6 +4,8 @@ GUI for git-sound
 """
 
 import sys
+import threading
+
 import gi
 gi.require_version('Gtk', '3.0')
 
@@ -14,6 +16,14 @@ from git.exc import InvalidGitRepositoryError
 from git import Repo
 
 from .gitmidi import GitMIDI
+from .notesummary import NoteSummary
+from .pianoroll import PianoRoll
+
+# Number of commit buckets in the preview track
+PREVIEW_BUCKETS = 64
+
+# Playback position update interval, in milliseconds
+POSITION_INTERVAL = 50
 
 
 class GitSoundWindow(object):
@@ -46,6 +56,12 @@ class GitSoundWindow(object):
         self.save_button = self.builder.get_object('save-button')
 
         self.gitmidi = None
+        self.midi_ready = False
+        self.__time_index = None
+        self.__full_midi = None
+        self.__gitmidi_source = None
+        self.__render_id = 0
+        self.__rendering = None
 
         program_store = self.builder.get_object('program-list')
 
@@ -74,6 +90,12 @@ class GitSoundWindow(object):
             'save_midi': lambda button: self.save_midi(),
         })
 
+        # Put the piano roll above the status bar
+        self.pianoroll = PianoRoll()
+        grid = self.builder.get_object('grid')
+        grid.insert_row(10)
+        grid.attach(self.pianoroll, 0, 10, 4, 1)
+
         self.win.connect("delete-event", Gtk.main_quit)
 
     def read_branches(self):
@@ -84,6 +106,10 @@ class GitSoundWindow(object):
 
         # Make sure the Play, Stop and Save buttons are disabled
         self.gitmidi = None
+        self.pianoroll.set_summary(None)
+        self.midi_ready = False
+        self.__full_midi = None
+        self.__render_id += 1
         repo_path = self.chooser_button.get_file().get_path()
         self.branch_combo.remove_all()
         self.branch_combo.set_button_sensitivity(False)
@@ -126,7 +152,8 @@ class GitSoundWindow(object):
         """
 
         self.stop_midi()
-        self.gitmidi = None
+        self.midi_ready = False
+        self.__render_id += 1
         self.set_buttons_sensitivity()
 
     def set_buttons_sensitivity(self, disable_all=False):
@@ -146,10 +173,11 @@ class GitSoundWindow(object):
 
             return
 
-        if self.gitmidi is not None:
+        if self.midi_ready:
             self.generate_button.set_sensitive(False)
             self.play_button.set_sensitive(True)
-            self.save_button.set_sensitive(True)
+            # Don’t let the user save the preview as if it was the track
+            self.save_button.set_sensitive(self.__rendering is None)
 
             return
 
@@ -176,26 +204,165 @@ class GitSoundWindow(object):
         notelen = self.notelen_spin.get_value()
         beatlen = int(self.beatlen_spin.get_value()) or None
 
+        settings = {
+            'scale': self.__scales[scale_selected][1],
+            'program': self.__programs[program_selected],
+            'volume_range': vol_deviation,
+            'skip': skip,
+            'note_duration': notelen,
+            'max_beat_len': beatlen,
+        }
+        source = (repo_path, branch_selected)
+
+        self.__render_id += 1
         self.progressbar.set_fraction(0.0)
         self.progressbar.pulse()
         self.set_status("Reading commits")
+
+        # Keep the GitMIDI object if only the generation parameters have
+        # changed, so it can reuse the stages that are still up to date.
+        # If it is still being rendered in the background, start over.
+        if self.__full_midi is None or \
+           self.__gitmidi_source != source or \
+           self.__rendering is not None:
+            self.__full_midi = GitMIDI(repository=repo_path,
+                                      branch=branch_selected,
+                                      verbose=False,
+                                      **settings)
+            self.__gitmidi_source = source
+        else:
+            self.__full_midi.configure(**settings)
+            self.__full_midi.refresh()
+
+        # If the commit data is already mapped, skip the preview, and
+        # only generate the rest in the background
+        if not self.__full_midi.is_stale('mapping'):
+            self.set_status("Generating MIDI")
+            self.set_buttons_sensitivity(disable_all=True)
+            self.__start_full_render()
+
+            return
+
+        self.set_status("Generating preview")
         self.gitmidi = GitMIDI(repository=repo_path,
                                branch=branch_selected,
                                verbose=False,
-                               scale=self.__scales[scale_selected][1],
-                               program=self.__programs[program_selected],
-                               volume_range=vol_deviation,
-                               skip=skip,
-                               note_duration=notelen,
-                               max_beat_len=beatlen)
-
-        self.set_status("Generating beats")
+                               preview=PREVIEW_BUCKETS,
+                               **settings)
         self.gitmidi.gen_repo_data(callback=self.genrepo_cb)
-        self.set_status("Generating MIDI")
-        self.gitmidi.generate_midi(callback=self.genrepo_cb)
         self.gitmidi.write_mem()
+        self.__time_index = self.gitmidi.time_index
+        self.pianoroll.set_summary(NoteSummary(self.gitmidi.iter_notes()))
+        self.midi_ready = True
+        self.__rendering = self.__render_id
 
         self.set_buttons_sensitivity(disable_all=False)
+        self.set_status(u"Preview ready, generating the full track…")
+        self.__start_full_render()
+
+    def __start_full_render(self):
+        """
+        Start generating the full track in a background thread.
+        """
+
+        self.__rendering = self.__render_id
+        self.progressbar.set_fraction(0.0)
+
+        thread = threading.Thread(target=self.__render_full,
+                                  args=(self.__full_midi, self.__render_id))
+        thread.daemon = True
+        thread.start()
+
+    def __render_full(self, full_midi, render_id):
+        """
+        Generate the full track.  This runs in a background thread, so
+        it must only touch the GUI through GLib.idle_add().
+        """
+
+        def progress_cb(max_count, current):
+            if max_count is not None and current % 100 == 0:
+                GLib.idle_add(self.__render_progress,
+                              render_id, float(current) / float(max_count))
+
+        try:
+            full_midi.gen_repo_data(callback=progress_cb)
+            full_midi.generate_midi(callback=progress_cb)
+            full_midi.write_mem()
+            time_index = full_midi.time_index
+            summary = NoteSummary(full_midi.iter_notes())
+        except Exception as error:
+            GLib.idle_add(self.__full_render_failed, error, render_id)
+
+            return
+
+        GLib.idle_add(self.__full_render_done,
+                      full_midi, time_index, summary, render_id)
+
+    def __full_render_failed(self, error, render_id):
+        """
+        Report a failed background render.  The preview (if any) can't
+        be saved, but Generate can be used to try again.
+        """
+
+        if self.__rendering == render_id:
+            self.__rendering = None
+
+        # The settings have changed since this render started
+        if render_id != self.__render_id:
+            return False
+
+        self.stop_midi()
+        self.midi_ready = False
+        self.progressbar.set_fraction(0.0)
+        self.set_buttons_sensitivity()
+        self.set_status("Generating the full track failed: {}".format(error))
+
+        return False
+
+    def __render_progress(self, render_id, fraction):
+        """
+        Update the progress bar during background rendering.
+        """
+
+        if render_id == self.__render_id:
+            self.progressbar.set_fraction(fraction)
+
+        return False
+
+    def __full_render_done(self, full_midi, time_index, summary, render_id):
+        """
+        Show the full track once it is generated, replacing the preview
+        if there is one.
+        """
+
+        if self.__rendering == render_id:
+            self.__rendering = None
+
+        # The settings have changed since this render started
+        if render_id != self.__render_id:
+            return False
+
+        was_playing = self.gitmidi is not None and \
+            self.gitmidi.get_play_pos() is not None
+        self.stop_midi()
+        self.gitmidi = full_midi
+        self.midi_ready = True
+        self.__time_index = time_index
+        self.pianoroll.set_summary(summary)
+        self.progressbar.set_fraction(1.0)
+        self.set_status("Full track generated")
+
+        # Start the full track from the beginning if the preview was
+        # playing (pygame can’t seek in MIDI files).  The playback
+        # position timer is still running in this case.
+        if was_playing:
+            self.set_status(u"Playing…")
+            self.gitmidi.play(track=True)
+            self.save_button.set_sensitive(True)
+        else:
+            self.set_buttons_sensitivity(disable_all=False)
+
+        return False
 
     def genrepo_cb(self, max_count, current):
         """
@@ -215,7 +382,7 @@ class GitSoundWindow(object):
 
     def update_play_pos(self):
         """
-        Update playback position label.
+        Update playback position label and the piano roll.
         """
 
         if self.gitmidi is None:
@@ -228,15 +395,23 @@ class GitSoundWindow(object):
             self.pos_label.set_text("0:00")
             self.play_button.set_sensitive(True)
             self.stop_button.set_sensitive(False)
+            self.pianoroll.set_position(None)
 
             return False
 
+        entry = self.__time_index.entry_at_ms(position)
+        self.pianoroll.set_position(position * self.gitmidi.tempo / 60000.0)
         position = int(position / 1000)
 
         minutes = int(position / 60)
         seconds = position - (minutes * 60)
 
-        self.pos_label.set_text("{}:{:02}".format(minutes, seconds))
+        if entry is None:
+            self.pos_label.set_text("{}:{:02}".format(minutes, seconds))
+        else:
+            self.pos_label.set_text("{}:{:02} {}".format(minutes,
+                                                          seconds,
+                                                          entry.sha[:7]))
 
         return True
 
@@ -247,7 +422,7 @@ class GitSoundWindow(object):
 
         self.set_status(u"Playing…")
         self.gitmidi.play(track=True)
-        GLib.timeout_add_seconds(1, self.update_play_pos)
+        GLib.timeout_add(POSITION_INTERVAL, self.update_play_pos)
         self.play_button.set_sensitive(False)
         self.stop_button.set_sensitive(True)
 
@@ -0,0 +1,169 @@
+# -*- coding: utf-8
+"""
+Level of detail summary of the notes of a track, for drawing them.
+"""
+
+from __future__ import print_function
+
+from array import array
+from bisect import bisect_left, bisect_right
+
+# Width of the cells on level 1, in beats.  Every further level has
+# twice as wide cells.
+BASE_WIDTH = 1.0
+
+# Draw the notes themselves if a level 1 cell would be at least this
+# many pixels wide
+NOTE_LEVEL_PIXELS = 8
+
+# Minimum width of the cells drawn, in pixels.  Narrower cells would
+# only multiply the number of rectangles to draw.
+CELL_PIXELS = 4
+
+
+class NoteSummary(object):
+    """
+    Summary of the notes of a track on several levels of detail.
+
+    Level 0 holds the notes themselves, sorted by start time.  Level n
+    (n >= 1) divides the track into cells of BASE_WIDTH * 2^(n - 1)
+    beats, and holds the loudest volume of every (pitch, channel) pair
+    sounding in each cell.  Levels are added until a single cell covers
+    the whole track, so the number of items to draw for any view only
+    depends on the size of the view, not on the length of the track.
+    """
+
+    def __init__(self, notes):
+        """
+        notes is an iterable of (channel, pitch, time, duration, volume)
+        tuples, like the ones generated by GitMIDI.iter_notes().
+        """
+
+        notes = sorted(notes, key=lambda note: note[2])
+
+        self.__starts = array('d', (note[2] for note in notes))
+        self.__durations = array('d', (note[3] for note in notes))
+        self.__channels = array('B', (note[0] for note in notes))
+        self.__pitches = array('B', (note[1] for note in notes))
+        self.__volumes = array('B', (note[4] for note in notes))
+        self.__max_duration = max(self.__durations) if notes else 0
+
+        self.length = max([note[2] + note[3] for note in notes] or [0])
+        self.min_pitch = min(self.__pitches) if notes else 0
+        self.max_pitch = max(self.__pitches) if notes else 127
+
+        self.__levels = [None]
+        cells = self.__first_level(notes)
+        self.__add_level(cells)
+
+        while self.level_width(len(self.__levels) - 1) < self.length:
+            cells = self.__merge_level(cells)
+            self.__add_level(cells)
+
+    @staticmethod
+    def level_width(level):
+        """
+        Get the width of the cells on a level, in beats.
+        """
+
+        return BASE_WIDTH * 2 ** (level - 1)
+
+    @staticmethod
+    def __first_level(notes):
+        """
+        Calculate the cells of level 1 from the notes.
+        """
+
+        cells = {}
+
+        for channel, pitch, time, duration, volume in notes:
+            first = int(time / BASE_WIDTH)
+            last = max(first, int((time + duration) / BASE_WIDTH - 1e-9))
+
+            for cell in range(first, last + 1):
+                key = (cell, pitch, channel)
+
+                if cells.get(key, -1) < volume:
+                    cells[key] = volume
+
+        return cells
+
+    @staticmethod
+    def __merge_level(cells):
+        """
+        Calculate the cells of the next level by merging pairs of cells.
+        """
+
+        merged = {}
+
+        for (cell, pitch, channel), volume in cells.items():
+            key = (cell // 2, pitch, channel)
+
+            if merged.get(key, -1) < volume:
+                merged[key] = volume
+
+        return merged
+
+    def __add_level(self, cells):
+        """
+        Store the cells of a level in compact, sorted arrays.
+        """
+
+        keys = sorted(cells)
+
+        self.__levels.append((array('L', (key[0] for key in keys)),
+                              array('B', (key[1] for key in keys)),
+                              array('B', (key[2] for key in keys)),
+                              array('B', (cells[key] for key in keys))))
+
+    @property
+    def levels(self):
+        """
+        Get the number of levels, including level 0.
+        """
+
+        return len(self.__levels)
+
+    def choose_level(self, beats_per_pixel):
+        """
+        Choose the level to draw with a given zoom level: the most
+        detailed one where cells are at least CELL_PIXELS pixels wide.
+        """
+
+        if self.level_width(1) / beats_per_pixel >= NOTE_LEVEL_PIXELS:
+            return 0
+
+        for level in range(1, len(self.__levels)):
+            if self.level_width(level) / beats_per_pixel >= CELL_PIXELS:
+                return level
+
+        return len(self.__levels) - 1
+
+    def visible(self, level, start, end):
+        """
+        Generate the items of a level between start and end (in
+        beats), as (time, duration, pitch, channel, volume) tuples.
+        """
+
+        if level == 0:
+            first = bisect_left(self.__starts, start - self.__max_duration)
+            last = bisect_right(self.__starts, end)
+
+            for i in range(first, last):
+                if self.__starts[i] + self.__durations[i] < start:
+                    continue
+
+                yield (self.__starts[i], self.__durations[i],
+                       self.__pitches[i], self.__channels[i],
+                       self.__volumes[i])
+
+            return
+
+        width = self.level_width(level)
+        cells, pitches, channels, volumes = self.__levels[level]
+        first = bisect_left(cells, int(start / width))
+        last = bisect_right(cells, int(end / width))
+
+        for i in range(first, last):
+            yield (cells[i] * width, width,
+                   pitches[i], channels[i], volumes[i])
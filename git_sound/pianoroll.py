@@ -0,0 +1,174 @@
+# -*- coding: utf-8
+"""
+Piano roll widget for git-sound
+"""
+
+import gi
+gi.require_version('Gtk', '3.0')
+gi.require_version('Gdk', '3.0')
+
+from gi.repository import Gdk
+from gi.repository import Gtk
+
+# Colours of the MIDI channels (commit and file notes)
+CHANNEL_COLOURS = {
+    0: (0.20, 0.45, 0.85),
+    1: (0.90, 0.55, 0.15),
+}
+
+# Zoom limits, in beats per pixel
+MIN_ZOOM = 0.005
+MAX_ZOOM = 10000.0
+
+ZOOM_STEP = 1.25
+
+# Volumes are drawn with this many distinct opacities, so rectangles
+# can be filled in batches
+VOLUME_BUCKETS = 8
+
+
+class PianoRoll(Gtk.DrawingArea):
+    """
+    Scrollable, zoomable piano roll of a track.
+
+    Only the visible part of the track is drawn, from a NoteSummary on
+    the level of detail matching the zoom, so drawing takes the same
+    time regardless of the length of the track.
+
+    Scrolling pans the view, Ctrl+scrolling zooms.  The view follows
+    the playback position until the user pans it.
+    """
+
+    def __init__(self):
+        Gtk.DrawingArea.__init__(self)
+
+        self.__summary = None
+        self.__beats_per_pixel = 0.05
+        self.__offset = 0.0
+        self.__position = None
+        self.__follow = True
+
+        self.set_size_request(-1, 160)
+        self.set_hexpand(True)
+        self.set_vexpand(True)
+        self.add_events(Gdk.EventMask.SCROLL_MASK |
+                        Gdk.EventMask.SMOOTH_SCROLL_MASK)
+
+        self.connect('draw', self.__draw)
+        self.connect('scroll-event', self.__scroll)
+
+    def set_summary(self, summary):
+        """
+        Show a new track (a NoteSummary, or None to clear the view).
+        """
+
+        self.__summary = summary
+        self.__offset = 0.0
+        self.__position = None
+        self.__follow = True
+        self.queue_draw()
+
+    def set_position(self, position):
+        """
+        Set the playback position (in beats), or None if not playing.
+        """
+
+        self.__position = position
+
+        if position is not None and self.__follow:
+            visible = self.get_allocated_width() * self.__beats_per_pixel
+
+            if position < self.__offset or \
+               position > self.__offset + visible * 0.9:
+                self.__offset = max(0.0, position - visible * 0.1)
+
+        self.queue_draw()
+
+    def __scroll(self, widget, event):
+        """
+        Pan or zoom the view.
+        """
+
+        if event.direction == Gdk.ScrollDirection.SMOOTH:
+            _, delta_x, delta_y = event.get_scroll_deltas()
+        elif event.direction in (Gdk.ScrollDirection.UP,
+                                 Gdk.ScrollDirection.LEFT):
+            delta_x = delta_y = -1
+        else:
+            delta_x = delta_y = 1
+
+        if event.state & Gdk.ModifierType.CONTROL_MASK:
+            # Zoom around the pointer
+            pointer_beat = self.__offset + event.x * self.__beats_per_pixel
+            self.__beats_per_pixel = min(
+                MAX_ZOOM,
+                max(MIN_ZOOM,
+                    self.__beats_per_pixel * ZOOM_STEP ** delta_y))
+            self.__offset = max(
+                0.0,
+                pointer_beat - event.x * self.__beats_per_pixel)
+        else:
+            delta = delta_x if delta_x else delta_y
+            self.__offset = max(
+                0.0,
+                self.__offset +
+                delta * self.get_allocated_width() *
+                self.__beats_per_pixel / 10)
+            self.__follow = False
+
+        self.queue_draw()
+
+        return True
+
+    def __draw(self, widget, cr):
+        """
+        Draw the visible part of the track.
+        """
+
+        width = self.get_allocated_width()
+        height = self.get_allocated_height()
+
+        cr.set_source_rgb(0.1, 0.1, 0.1)
+        cr.paint()
+
+        if self.__summary is None:
+            return False
+
+        summary = self.__summary
+        pitch_count = summary.max_pitch - summary.min_pitch + 1
+        row_height = float(height) / pitch_count
+        start = self.__offset
+        end = start + width * self.__beats_per_pixel
+        level = summary.choose_level(self.__beats_per_pixel)
+
+        # Group the rectangles by colour, and fill each group at once
+        batches = {}
+        bucket_size = 128 // VOLUME_BUCKETS
+
+        for time, duration, pitch, channel, volume in \
+                summary.visible(level, start, end):
+            batches.setdefault((channel, volume // bucket_size), []).append(
+                ((time - start) / self.__beats_per_pixel,
+                 (summary.max_pitch - pitch) * row_height,
+                 max(1.0, duration / self.__beats_per_pixel),
+                 max(1.0, row_height)))
+
+        for (channel, bucket), rectangles in batches.items():
+            red, green, blue = CHANNEL_COLOURS.get(channel, (0.6, 0.6, 0.6))
+            volume = (bucket + 0.5) * bucket_size
+            cr.set_source_rgba(red, green, blue, 0.25 + volume / 170.0)
+
+            for rectangle in rectangles:
+                cr.rectangle(*rectangle)
+
+            cr.fill()
+
+        if self.__position is not None:
+            cr.set_source_rgb(1.0, 1.0, 1.0)
+            cr.set_line_width(1.0)
+            cr.move_to((self.__position - start) / self.__beats_per_pixel,
+                       0)
+            cr.rel_line_to(0, height)
+            cr.stroke()
+
+        return False
@@ -0,0 +1,442 @@
+# -*- coding: utf-8
+"""
+A local HTTP server that renders repositories on request, and caches
+the results.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+from git import Repo
+from git.exc import InvalidGitRepositoryError, NoSuchPathError
+
+from .gitmidi import GitMIDI
+
+# Change this if the generated MIDI data changes for the same settings,
+# so old cache entries are not used any more
+CACHE_VERSION = 1
+
+NUMERIC_PARAMS = {
+    'volume_range': int,
+    'skip': int,
+    'note_duration': float,
+    'max_beat_len': int,
+    'tempo': int,
+}
+
+
+class RequestError(Exception):
+    """
+    Error in a render request, with the HTTP status to respond with.
+    """
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def cache_key(head_sha, settings):
+    """
+    Calculate the cache key of a render from the branch head and the
+    generation settings.
+    """
+
+    data = json.dumps([CACHE_VERSION, head_sha, settings], sort_keys=True)
+
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+class RenderCache(object):
+    """
+    Size-bounded, two level (memory and disk) cache of rendered MIDI
+    data.  Concurrent requests for the same key are coalesced, so each
+    key is rendered only once.
+    """
+
+    def __init__(self, directory=None, max_memory=None, max_disk=None):
+        self.__directory = directory
+        self.__max_memory = max_memory or 64 * 1024 * 1024
+        self.__max_disk = max_disk or 1024 * 1024 * 1024
+        self.__memory = OrderedDict()
+        self.__memory_size = 0
+        self.__pending = {}
+        self.__lock = threading.Lock()
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __disk_path(self, key):
+        """
+        Get the disk path of a cache entry.
+        """
+
+        return os.path.join(self.__directory, key + '.mid')
+
+    def __remember(self, key, data):
+        """
+        Put data into the memory cache, and evict the least recently
+        used entries if it grows too big.  Must be called with the lock
+        held.
+        """
+
+        if len(data) > self.__max_memory:
+            return
+
+        if key in self.__memory:
+            self.__memory_size -= len(self.__memory.pop(key))
+
+        self.__memory[key] = data
+        self.__memory_size += len(data)
+
+        while self.__memory_size > self.__max_memory:
+            _, evicted = self.__memory.popitem(last=False)
+            self.__memory_size -= len(evicted)
+
+    def __read_disk(self, key):
+        """
+        Read an entry from the disk cache, or return None if it is not
+        there.
+        """
+
+        if self.__directory is None:
+            return None
+
+        path = self.__disk_path(key)
+
+        try:
+            with open(path, 'rb') as cache_file:
+                data = cache_file.read()
+        except (IOError, OSError):
+            return None
+
+        # Keep the modification time as the time of last use
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return data
+
+    def __write_disk(self, key, data):
+        """
+        Write an entry to the disk cache, and remove the least recently
+        used entries if the cache grows too big.
+        """
+
+        if self.__directory is None:
+            return
+
+        handle, temp_path = tempfile.mkstemp(dir=self.__directory,
+                                             suffix='.tmp')
+
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(data)
+
+        os.replace(temp_path, self.__disk_path(key))
+
+        entries = []
+
+        for name in os.listdir(self.__directory):
+            if not name.endswith('.mid'):
+                continue
+
+            path = os.path.join(self.__directory, name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(entry[1] for entry in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.__max_disk:
+                break
+
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def get(self, key):
+        """
+        Get a cached entry, or None if it is not cached.
+        """
+
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+
+                return self.__memory[key]
+
+        data = self.__read_disk(key)
+
+        if data is not None:
+            with self.__lock:
+                self.__remember(key, data)
+
+        return data
+
+    def get_or_render(self, key, render):
+        """
+        Get a cached entry, or create it by calling render().  If the
+        same key is already being rendered, wait for that render
+        instead of starting a new one.
+        """
+
+        while True:
+            data = self.get(key)
+
+            if data is not None:
+                return data
+
+            with self.__lock:
+                pending = self.__pending.get(key)
+
+                if pending is None:
+                    pending = threading.Event()
+                    self.__pending[key] = pending
+                    owner = True
+                else:
+                    owner = False
+
+            if not owner:
+                pending.wait()
+
+                # If the render failed, try it again ourselves
+                continue
+
+            try:
+                data = render()
+
+                with self.__lock:
+                    self.__remember(key, data)
+
+                self.__write_disk(key, data)
+
+                return data
+            finally:
+                with self.__lock:
+                    del self.__pending[key]
+
+                pending.set()
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handle render requests.
+
+    The only endpoint is /render, with the query parameters repo,
+    branch, scale, program, and optionally volume_range, skip,
+    note_duration, max_beat_len and tempo.
+    """
+
+    def __parse_request(self):
+        """
+        Parse and validate the query parameters of the request.
+        """
+
+        url = urlparse(self.path)
+
+        if url.path != '/render':
+            raise RequestError(404, "Not found")
+
+        query = dict((name, values[-1])
+                     for name, values in parse_qs(url.query).items())
+
+        for name in ('repo', 'scale', 'program'):
+            if name not in query:
+                raise RequestError(400, "Missing parameter: " + name)
+
+        if query['scale'] not in self.server.scales:
+            raise RequestError(400, "Unknown scale: " + query['scale'])
+
+        if query['program'] not in self.server.programs:
+            raise RequestError(400, "Unknown program: " + query['program'])
+
+        repo_path = query['repo']
+
+        if self.server.root is not None:
+            root = os.path.realpath(self.server.root)
+            repo_path = os.path.realpath(os.path.join(root, repo_path))
+
+            if os.path.commonprefix([root + os.sep, repo_path + os.sep]) != \
+               root + os.sep:
+                raise RequestError(404, "Unknown repository")
+
+        settings = {
+            'scale': self.server.scales[query['scale']],
+            'program': self.server.programs[query['program']],
+        }
+
+        for name, convert in NUMERIC_PARAMS.items():
+            try:
+                settings[name] = convert(query[name]) \
+                    if name in query else None
+            except ValueError:
+                raise RequestError(400, "Invalid value for " + name)
+
+        return repo_path, query.get('branch', 'master'), settings
+
+    def __prepare(self):
+        """
+        Get the cache key of the request, and a function rendering its
+        MIDI data.
+        """
+
+        repo_path, branch, settings = self.__parse_request()
+
+        try:
+            head_sha = Repo(repo_path).heads[branch].commit.hexsha
+        except (InvalidGitRepositoryError, NoSuchPathError):
+            raise RequestError(404, "Unknown repository")
+        except IndexError:
+            raise RequestError(404, "Unknown branch: " + branch)
+
+        key = cache_key(head_sha, settings)
+
+        def render():
+            midi = GitMIDI(repository=repo_path,
+                           branch=branch,
+                           head=head_sha,
+                           **settings)
+            midi.write_mem(jobs=1)
+
+            return midi.midi_data
+
+        return key, render
+
+    def __respond(self, send_body):
+        """
+        Respond to a GET or HEAD request.
+        """
+
+        try:
+            key, render = self.__prepare()
+        except RequestError as error:
+            self.send_error(error.status, str(error))
+
+            return
+
+        # The key only depends on the head and the settings, so
+        # revalidation never needs a render
+        etag = '"{}"'.format(key)
+
+        if etag in [tag.strip()
+                    for tag in self.headers.get('If-None-Match',
+                                                '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+
+            return
+
+        try:
+            data = self.server.cache.get_or_render(key, render)
+        except Exception as error:
+            # Always log failures, even if not in verbose mode
+            BaseHTTPRequestHandler.log_message(self, "Render failed: %r",
+                                               error)
+            self.send_error(500, "Render failed")
+
+            return
+
+        status = 200
+        start, end = 0, len(data) - 1
+        range_header = self.headers.get('Range')
+
+        if range_header is not None:
+            match = re.match(r'^bytes=(\d*)-(\d*)$', range_header.strip())
+
+            if match is None or match.groups() == ('', ''):
+                start = None
+            elif match.group(1) == '':
+                start = max(len(data) - int(match.group(2)), 0)
+            else:
+                start = int(match.group(1))
+
+                if match.group(2) != '':
+                    end = min(int(match.group(2)), end)
+
+            if start is None or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range',
+                                 'bytes */{}'.format(len(data)))
+                self.end_headers()
+
+                return
+
+            status = 206
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'audio/midi')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+
+        if status == 206:
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, end, len(data)))
+
+        self.end_headers()
+
+        if send_body:
+            self.wfile.write(data[start:end + 1])
+
+    def do_GET(self):
+        """
+        Handle GET requests.
+        """
+
+        self.__respond(True)
+
+    def do_HEAD(self):
+        """
+        Handle HEAD requests.
+        """
+
+        self.__respond(False)
+
+    def log_message(self, format, *args):
+        """
+        Log requests only in verbose mode.
+        """
+
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class RenderServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server for rendering repositories.
+    """
+
+    daemon_threads = True
+
+    def __init__(self,
+                 address,
+                 scales,
+                 programs,
+                 cache=None,
+                 root=None,
+                 verbose=None):
+        HTTPServer.__init__(self, address, RenderRequestHandler)
+
+        self.scales = scales
+        self.programs = programs
+        self.cache = cache or RenderCache()
+        self.root = root
+        self.verbose = verbose or False
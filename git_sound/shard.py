@@ -0,0 +1,301 @@
+# -*- coding: utf-8
+"""
+Split the rendering of a long history into shards that can run on
+separate machines (or processes), and merge their partial results.
+
+Every shard reads the commits of one part of the history, and saves
+their records in a portable, JSON encoded partial file.  The partial
+files are collected in a shared directory, and the merge step stitches
+them back together into a single timeline, in the same order as the
+full history.  As note timing is calculated from the merged timeline,
+every commit ends up at the correct offset in the final track.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import re
+import tempfile
+from multiprocessing import Pool
+
+from git import Repo
+
+from .gitmidi import GitMIDI, commit_record
+
+MAGIC = 'git-sound-shard'
+VERSION = 1
+
+SHARD_FILE_RE = re.compile(r'^shard-(\d+)-of-(\d+)\.json$')
+
+
+class ShardError(Exception):
+    """
+    Error in a set of partial files.
+    """
+
+    pass
+
+
+def shard_filename(shard_dir, shard, shards):
+    """
+    Get the name of the partial file of a shard.
+    """
+
+    return os.path.join(shard_dir,
+                        'shard-{:04d}-of-{:04d}.json'.format(shard, shards))
+
+
+def list_history(repo, head):
+    """
+    List the history reachable from head (a SHA1 ID) as (authoring
+    date, SHA1 ID) pairs, sorted by date.  Commits with the same date
+    are sorted by their SHA1 ID, so every shard gets the same list.
+    """
+
+    log = repo.git.log('--format=%at %H', head)
+
+    return sorted((int(timestamp), sha)
+                  for timestamp, sha in (line.split()
+                                         for line in log.splitlines()))
+
+
+def split_history(entries, shards, by=None):
+    """
+    Split the (date, SHA1 ID) pairs of the history into shards, either
+    with the same number of commits in each ('count', the default), or
+    covering the same time span each ('date').  Returns a list of shards
+    entries lists; with 'date', some of them may be empty.
+    """
+
+    count = len(entries)
+
+    if by == 'date' and count > 0:
+        first = entries[0][0]
+        width = float(entries[-1][0] - first) / shards or 1
+        parts = [[] for _ in range(shards)]
+
+        for entry in entries:
+            index = min(int((entry[0] - first) / width), shards - 1)
+            parts[index].append(entry)
+
+        return parts
+
+    return [entries[i * count // shards:(i + 1) * count // shards]
+            for i in range(shards)]
+
+
+def render_shard(repository,
+                 shard,
+                 shards,
+                 shard_dir,
+                 branch=None,
+                 by=None,
+                 skip=None,
+                 head=None,
+                 verbose=None,
+                 callback=None):
+    """
+    Read the commits of a single shard (numbered from 0), and save
+    their records to the shard’s partial file in shard_dir.
+
+    All shards of a render must use the same head, so they split the
+    same history.  If head (a SHA1 ID) is not set, the head of branch
+    is used.  The first skip commits of the history are left out.
+    Returns the name of the partial file.
+    """
+
+    if not 0 <= shard < shards:
+        raise ValueError("Invalid shard {}/{}".format(shard, shards))
+
+    repo = Repo(repository)
+
+    if head is None:
+        head = repo.heads[branch or 'master'].commit.hexsha
+
+    if verbose:
+        print("Listing history of {}…".format(head))
+
+    entries = list_history(repo, head)[skip or 0:]
+    parts = split_history(entries, shards, by=by)
+    start = sum(len(part) for part in parts[:shard])
+
+    records = []
+    commit_count = len(parts[shard])
+
+    for current, (_, sha) in enumerate(parts[shard], 1):
+        if callback:
+            callback(commit_count, current)
+
+        if verbose:
+            print("{}/{}".format(current, commit_count))
+
+        records.append(commit_record(repo.commit(sha)))
+
+    partial = {
+        'magic': MAGIC,
+        'version': VERSION,
+        'head': head,
+        'skip': skip or 0,
+        'by': by or 'count',
+        'shard': shard,
+        'shards': shards,
+        'start': start,
+        'total': len(entries),
+        'records': records,
+    }
+
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    filename = shard_filename(shard_dir, shard, shards)
+
+    # Write to a temporary file first, so the merge step never sees a
+    # partially written file in the shared directory
+    handle, temp_path = tempfile.mkstemp(dir=shard_dir, suffix='.tmp')
+
+    with os.fdopen(handle, 'w') as temp_file:
+        json.dump(partial, temp_file)
+
+    os.replace(temp_path, filename)
+
+    return filename
+
+
+def _render_shard_args(arguments):
+    """
+    Call render_shard() with a tuple of positional and keyword
+    arguments, in a worker process.
+    """
+
+    args, kwargs = arguments
+
+    return render_shard(*args, **kwargs)
+
+
+def render_shards(repository,
+                  shards,
+                  shard_dir,
+                  branch=None,
+                  by=None,
+                  skip=None,
+                  jobs=None,
+                  verbose=None):
+    """
+    Render all the shards on this machine, in jobs worker processes
+    (by default, one per CPU).  Returns the names of the partial files.
+    """
+
+    head = Repo(repository).heads[branch or 'master'].commit.hexsha
+    settings = {
+        'by': by,
+        'skip': skip,
+        'head': head,
+        'verbose': verbose,
+    }
+
+    pool = Pool(processes=jobs)
+
+    try:
+        return pool.map(_render_shard_args,
+                        [((repository, shard, shards, shard_dir), settings)
+                         for shard in range(shards)])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_partials(shard_dir):
+    """
+    Load and check the partial files in shard_dir.  Returns the head
+    the shards were rendered from, and the commit records of the whole
+    history, in order.
+
+    Raises ShardError if the partial files are from different renders,
+    or some of them are missing.
+    """
+
+    if not os.path.isdir(shard_dir):
+        raise ShardError("{} is not a directory".format(shard_dir))
+
+    partials = []
+
+    for name in sorted(os.listdir(shard_dir)):
+        if SHARD_FILE_RE.match(name) is None:
+            continue
+
+        with open(os.path.join(shard_dir, name)) as partial_file:
+            partial = json.load(partial_file)
+
+        if partial.get('magic') != MAGIC or \
+           partial.get('version') != VERSION:
+            raise ShardError("{} is not a git-sound partial file"
+                             .format(name))
+
+        partials.append(partial)
+
+    if not partials:
+        raise ShardError("No partial files found in {}".format(shard_dir))
+
+    partials.sort(key=lambda partial: partial['shard'])
+    first = partials[0]
+
+    for partial in partials:
+        for key in ('head', 'skip', 'by', 'shards', 'total'):
+            if partial[key] != first[key]:
+                raise ShardError("Shard {} belongs to a different render "
+                                 "({} differs)".format(partial['shard'], key))
+
+    found = [partial['shard'] for partial in partials]
+
+    if found != list(range(first['shards'])):
+        missing = sorted(set(range(first['shards'])) - set(found))
+
+        raise ShardError("Missing shards: {}"
+                         .format(', '.join(str(shard) for shard in missing)))
+
+    records = []
+
+    for partial in partials:
+        if partial['start'] != len(records):
+            raise ShardError("Shard {} starts at commit {} instead of {}"
+                             .format(partial['shard'],
+                                     partial['start'],
+                                     len(records)))
+
+        records.extend(partial['records'])
+
+    if len(records) != first['total']:
+        raise ShardError("Shards have {} commits instead of {}"
+                         .format(len(records), first['total']))
+
+    return first['head'], records
+
+
+def merge_shards(shard_dir,
+                 verbose=None,
+                 scale=None,
+                 program=None,
+                 volume_range=None,
+                 note_duration=None,
+                 max_beat_len=None,
+                 tempo=None):
+    """
+    Merge the partial files in shard_dir into a single track.  Returns
+    a GitMIDI object generated from the merged commit records; the
+    other parameters have the same meaning as for GitMIDI.
+    """
+
+    head, records = load_partials(shard_dir)
+
+    if verbose:
+        print("Merged {} commits up to {}".format(len(records), head))
+
+    return GitMIDI(verbose=verbose,
+                   scale=scale,
+                   program=program,
+                   volume_range=volume_range,
+                   note_duration=note_duration,
+                   max_beat_len=max_beat_len,
+                   tempo=tempo,
+                   records=records)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8
+"""
+Stream the notes of a track as timestamped MIDI events over a local
+UDP or Unix datagram socket.
+
+Every datagram holds the events of a single tick:
+
+* a header: the magic bytes ``GS``, the protocol version, a sequence
+  number, the tick, the scheduled time of the tick in microseconds
+  since the start of the stream, and the number of events
+  (``>2sBIIQH``)
+* the events, each as three MIDI bytes (status and two data bytes;
+  unused data bytes are zero)
+
+Big ticks are split into several datagrams with the same tick.
+"""
+
+from __future__ import print_function
+
+import os
+import socket
+import struct
+from time import perf_counter, sleep
+
+from midiutil.MidiFile import TICKSPERBEAT
+
+MAGIC = b'GS'
+VERSION = 1
+HEADER = struct.Struct('>2sBIIQH')
+EVENT = struct.Struct('>BBB')
+
+# Maximum number of events in a single datagram
+MAX_EVENTS = 256
+
+# Time to busy-wait (instead of sleeping) before a tick is due, in
+# seconds.  This keeps the jitter well below the sleep granularity of
+# the OS.
+SPIN_TIME = 0.002
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+PROGRAM_CHANGE = 0xC0
+
+
+def parse_address(address):
+    """
+    Parse a stream address.  Addresses look like udp:HOST:PORT or
+    unix:PATH.  Returns a (family, address) tuple for socket calls.
+    """
+
+    kind, _, rest = address.partition(':')
+
+    if kind == 'udp':
+        host, _, port = rest.rpartition(':')
+
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+
+    if kind == 'unix':
+        return socket.AF_UNIX, rest
+
+    raise ValueError("Unknown stream address: {}".format(address))
+
+
+def midi_events(midi):
+    """
+    Convert the notes of a GitMIDI object to (tick, order, status,
+    data1, data2) tuples, sorted by time.  At the same tick, program
+    changes come first, then note offs, then note ons.
+    """
+
+    events = []
+
+    for channel, program in midi.channel_programs.items():
+        events.append((0, 0, PROGRAM_CHANGE | channel, program, 0))
+
+    for channel, pitch, time, duration, volume in \
+            midi.iter_notes(progress=False):
+        start = int(round(time * TICKSPERBEAT))
+        end = int(round((time + duration) * TICKSPERBEAT))
+
+        events.append((start, 2, NOTE_ON | channel, pitch, volume))
+        events.append((end, 1, NOTE_OFF | channel, pitch, 0))
+
+    events.sort()
+
+    return events
+
+
+def tick_batches(events):
+    """
+    Group the sorted events by tick.  Generates (tick, events) tuples.
+    """
+
+    batch = []
+    batch_tick = None
+
+    for event in events:
+        if event[0] != batch_tick and batch:
+            yield batch_tick, batch
+            batch = []
+
+        batch_tick = event[0]
+        batch.append(event[2:])
+
+    if batch:
+        yield batch_tick, batch
+
+
+def encode_packet(sequence, tick, time_us, events):
+    """
+    Encode a datagram.
+    """
+
+    return HEADER.pack(MAGIC, VERSION, sequence, tick, time_us,
+                       len(events)) + \
+        b''.join(EVENT.pack(*event) for event in events)
+
+
+def decode_packet(data):
+    """
+    Decode a datagram into a (sequence, tick, time_us, events) tuple.
+    """
+
+    magic, version, sequence, tick, time_us, count = \
+        HEADER.unpack_from(data)
+
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a git-sound stream packet")
+
+    events = [EVENT.unpack_from(data, HEADER.size + i * EVENT.size)
+              for i in range(count)]
+
+    return sequence, tick, time_us, events
+
+
+class EventStreamer(object):
+    """
+    Send MIDI events to a socket in real time.
+
+    The socket is non-blocking, so a receiver that stops reading can’t
+    stall the stream; datagrams that don’t fit into the socket buffer
+    are dropped, and counted in dropped.  Errors like a missing Unix
+    socket are raised as OSError.
+    """
+
+    def __init__(self, address):
+        family, self.__address = parse_address(address)
+        self.__socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.__socket.setblocking(False)
+        self.__sequence = 0
+        self.max_lateness = 0.0
+        self.dropped = 0
+
+    def send(self, tick, time_us, events):
+        """
+        Send the events of a tick right away.
+        """
+
+        for start in range(0, len(events), MAX_EVENTS):
+            try:
+                self.__socket.sendto(
+                    encode_packet(self.__sequence, tick, time_us,
+                                  events[start:start + MAX_EVENTS]),
+                    self.__address)
+            except BlockingIOError:
+                self.dropped += 1
+
+            self.__sequence = (self.__sequence + 1) & 0xFFFFFFFF
+
+    def stream(self, midi, stop=None, events=None):
+        """
+        Stream the notes of a GitMIDI object, sending every tick when it
+        is due according to the tempo of the track.  Runs until the
+        track ends or stop() returns True.
+
+        events may be the result of midi_events(midi), prepared in
+        advance so the stream can start right away (e.g. together with
+        playback).  The clock only starts once the events are ready.
+
+        The largest delay of a tick is kept in max_lateness (in
+        seconds).
+        """
+
+        if events is None:
+            midi.gen_repo_data()
+            events = midi_events(midi)
+
+        seconds_per_tick = 60.0 / midi.tempo / TICKSPERBEAT
+        start = perf_counter()
+
+        for tick, tick_events in tick_batches(events):
+            if stop is not None and stop():
+                break
+
+            due = tick * seconds_per_tick
+            remaining = due - (perf_counter() - start)
+
+            if remaining > SPIN_TIME:
+                sleep(remaining - SPIN_TIME)
+
+            while perf_counter() - start < due:
+                pass
+
+            self.send(tick, int(due * 1000000), tick_events)
+            self.max_lateness = max(self.max_lateness,
+                                    perf_counter() - start - due)
+
+    def close(self):
+        """
+        Close the socket.
+        """
+
+        self.__socket.close()
+
+
+class EventReceiver(object):
+    """
+    Reference receiver for the event stream.
+    """
+
+    def __init__(self, address):
+        family, self.__address = parse_address(address)
+        self.__socket = socket.socket(family, socket.SOCK_DGRAM)
+
+        if family == socket.AF_UNIX and os.path.exists(self.__address):
+            os.remove(self.__address)
+
+        self.__socket.bind(self.__address)
+
+    @property
+    def address(self):
+        """
+        Get the address the receiver is bound to.
+        """
+
+        return self.__socket.getsockname()
+
+    def receive(self, timeout=None):
+        """
+        Receive a datagram, and return it decoded (see decode_packet()),
+        or None if nothing arrived within timeout seconds.
+        """
+
+        self.__socket.settimeout(timeout)
+
+        try:
+            data = self.__socket.recv(65536)
+        except socket.timeout:
+            return None
+
+        return decode_packet(data)
+
+    def close(self):
+        """
+        Close the socket, and remove it if it is a Unix socket.
+        """
+
+        self.__socket.close()
+
+        if self.__socket.family == socket.AF_UNIX and \
+           os.path.exists(self.__address):
+            os.remove(self.__address)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8
+"""
+Render a repository with several scale and program combinations, while
+reading its history only once.
+"""
+
+from __future__ import print_function
+
+import os
+from multiprocessing import Pool
+
+from .gitmidi import GitMIDI
+
+# Commit records shared with the worker processes
+_RECORDS = None
+
+
+def _init_worker(records):
+    """
+    Store the commit records in a worker process, so they don’t have to
+    be sent along with every combination.
+    """
+
+    global _RECORDS
+
+    _RECORDS = records
+
+
+def render_combination(combination):
+    """
+    Render one (scale, program) combination from the commit records of
+    the current worker, and save it to a file.
+    """
+
+    scale, program, settings, filename = combination
+
+    midi = GitMIDI(scale=scale,
+                   program=program,
+                   records=_RECORDS,
+                   **settings)
+    midi.write_mem(jobs=1)
+    midi.export_file(filename)
+
+    return filename
+
+
+def sweep_filename(output_dir, scale_id, program_id):
+    """
+    Get the name of the output file for a combination.
+    """
+
+    return os.path.join(output_dir,
+                        '{}-{}.mid'.format(scale_id, program_id))
+
+
+def render_sweep(repository,
+                 scales,
+                 programs,
+                 output_dir,
+                 branch=None,
+                 verbose=None,
+                 volume_range=None,
+                 skip=None,
+                 note_duration=None,
+                 max_beat_len=None,
+                 tempo=None,
+                 jobs=None,
+                 callback=None):
+    """
+    Render every combination of scales (a dictionary of scale IDs and
+    note lists) and programs (a dictionary of program IDs and program
+    definitions) into output_dir.
+
+    The history is ingested once; mapping and encoding of the
+    combinations run in jobs worker processes (by default, one per
+    CPU).  Returns a dictionary of (scale ID, program ID) tuples and
+    the written file names.
+    """
+
+    if not scales or not programs:
+        return {}
+
+    first_scale = next(iter(scales.values()))
+    first_program = next(iter(programs.values()))
+
+    ingest = GitMIDI(repository=repository,
+                     branch=branch,
+                     verbose=verbose,
+                     scale=first_scale,
+                     program=first_program,
+                     skip=skip)
+    ingest.gen_repo_data(callback=callback)
+    records = ingest.records
+
+    settings = {
+        'volume_range': volume_range,
+        'note_duration': note_duration,
+        'max_beat_len': max_beat_len,
+        'tempo': tempo,
+    }
+
+    combinations = []
+    filenames = {}
+
+    for scale_id, scale in scales.items():
+        for program_id, program in programs.items():
+            filename = sweep_filename(output_dir, scale_id, program_id)
+            combinations.append((scale, program, settings, filename))
+            filenames[(scale_id, program_id)] = filename
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    if verbose:
+        print("Rendering {} combinations…".format(len(combinations)))
+
+    pool = Pool(processes=jobs,
+                initializer=_init_worker,
+                initargs=(records,))
+
+    try:
+        pool.map(render_combination, combinations)
+    finally:
+        pool.close()
+        pool.join()
+
+    return filenames
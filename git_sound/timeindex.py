@@ -0,0 +1,170 @@
+# -*- coding: utf-8
+"""
+Index of commits by their position in a generated track.
+"""
+
+from __future__ import print_function
+
+import binascii
+import struct
+from bisect import bisect_right
+from collections import namedtuple
+
+from midiutil.MidiFile import TICKSPERBEAT
+
+MAGIC = b'GSIX'
+VERSION = 1
+HEADER = struct.Struct('>4sBHdI')
+ENTRY = struct.Struct('>Iq20sII')
+
+IndexEntry = namedtuple('IndexEntry', ['tick',
+                                       'date',
+                                       'sha',
+                                       'first_file_note',
+                                       'file_note_count'])
+
+
+class TimeIndex(object):
+    """
+    Sorted list of (start tick, authoring date, commit SHA1 ID, first
+    file note, number of file notes) entries, one for every commit in
+    a track.  File notes are numbered from the start of the track.
+
+    Lookups by position or date are binary searches; lookups by SHA1
+    ID use a dictionary built on first use.
+    """
+
+    def __init__(self, entries, tempo, ticks_per_beat=None):
+        self.__entries = [IndexEntry(*entry) for entry in entries]
+        self.__ticks = [entry.tick for entry in self.__entries]
+        self.__dates = [entry.date for entry in self.__entries]
+        self.__positions = None
+        self.tempo = tempo
+        self.ticks_per_beat = ticks_per_beat or TICKSPERBEAT
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __getitem__(self, position):
+        return self.__entries[position]
+
+    def ms_to_tick(self, ms):
+        """
+        Convert a playback position in milliseconds to ticks.
+        """
+
+        return int(ms * self.tempo * self.ticks_per_beat / 60000.0)
+
+    def tick_to_ms(self, tick):
+        """
+        Convert ticks to a playback position in milliseconds.
+        """
+
+        return int(tick * 60000.0 / self.tempo / self.ticks_per_beat)
+
+    def entry_at_tick(self, tick):
+        """
+        Get the entry of the commit playing at tick, or None if tick is
+        before the first commit.
+        """
+
+        position = bisect_right(self.__ticks, tick) - 1
+
+        if position < 0:
+            return None
+
+        return self.__entries[position]
+
+    def entry_at_ms(self, ms):
+        """
+        Get the entry of the commit playing at ms milliseconds.
+        """
+
+        return self.entry_at_tick(self.ms_to_tick(ms))
+
+    def entry_at_date(self, date):
+        """
+        Get the entry of the last commit authored at or before date (a
+        UNIX timestamp), or None if there is no such commit.
+        """
+
+        position = bisect_right(self.__dates, date) - 1
+
+        if position < 0:
+            return None
+
+        return self.__entries[position]
+
+    def entry_of_commit(self, sha):
+        """
+        Get the entry of a commit by its SHA1 ID, or None if the commit
+        is not in the track.
+        """
+
+        if self.__positions is None:
+            self.__positions = dict((entry.sha, position)
+                                    for position, entry
+                                    in enumerate(self.__entries))
+
+        position = self.__positions.get(sha)
+
+        if position is None:
+            return None
+
+        return self.__entries[position]
+
+    def to_bytes(self):
+        """
+        Serialise the index.
+        """
+
+        return HEADER.pack(MAGIC, VERSION, self.ticks_per_beat,
+                           float(self.tempo), len(self.__entries)) + \
+            b''.join(ENTRY.pack(entry.tick,
+                                entry.date,
+                                binascii.unhexlify(entry.sha),
+                                entry.first_file_note,
+                                entry.file_note_count)
+                     for entry in self.__entries)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Load an index serialised by to_bytes().
+        """
+
+        magic, version, ticks_per_beat, tempo, count = \
+            HEADER.unpack_from(data)
+
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a git-sound time index")
+
+        entries = []
+
+        for position in range(count):
+            tick, date, sha, first_file_note, file_note_count = \
+                ENTRY.unpack_from(data, HEADER.size + position * ENTRY.size)
+            entries.append((tick,
+                            date,
+                            binascii.hexlify(sha).decode('ascii'),
+                            first_file_note,
+                            file_note_count))
+
+        return cls(entries, tempo, ticks_per_beat=ticks_per_beat)
+
+    def save(self, filename):
+        """
+        Save the index to a file.
+        """
+
+        with open(filename, 'wb') as index_file:
+            index_file.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an index from a file.
+        """
+
+        with open(filename, 'rb') as index_file:
+            return cls.from_bytes(index_file.read())
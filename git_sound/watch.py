@@ -0,0 +1,216 @@
+# -*- coding: utf-8
+"""
+Follow a branch of a repository, and generate beats for new commits as
+they appear.
+"""
+
+from __future__ import print_function
+
+import os
+from time import sleep
+
+from git import Repo
+
+try:
+    from inotify_simple import INotify, flags
+    INOTIFY_AVAILABLE = True
+except ImportError:
+    INOTIFY_AVAILABLE = False
+
+
+class RefWatcher(object):
+    """
+    Watch the ref of a branch (both the loose ref file and packed-refs)
+    for changes.  Uses inotify if it is available, and polling
+    otherwise.
+    """
+
+    def __init__(self, repository, branch, poll_interval=None):
+        repo = Repo(repository)
+
+        self.__git_dir = getattr(repo, 'common_dir', None) or repo.git_dir
+        self.__ref_name = 'refs/heads/' + branch
+        self.__ref_file = os.path.join(self.__git_dir,
+                                       *self.__ref_name.split('/'))
+        self.__packed_refs = os.path.join(self.__git_dir, 'packed-refs')
+        self.__poll_interval = poll_interval or 0.5
+        self.__inotify = None
+        self.__watched_dirs = set()
+
+        if INOTIFY_AVAILABLE:
+            self.__inotify = INotify()
+            self.__add_watches()
+
+    def __add_watches(self):
+        """
+        Watch the directories of the ref file and packed-refs.  Git
+        updates both by renaming a lock file, so watching the files
+        themselves is not enough.
+        """
+
+        mask = flags.CREATE | flags.MOVED_TO | flags.MODIFY | \
+            flags.CLOSE_WRITE | flags.DELETE
+
+        for directory in (self.__git_dir, os.path.dirname(self.__ref_file)):
+            if directory in self.__watched_dirs or \
+               not os.path.isdir(directory):
+                continue
+
+            self.__inotify.add_watch(directory, mask)
+            self.__watched_dirs.add(directory)
+
+    def read_head(self):
+        """
+        Get the SHA1 ID the branch points to, or None if the branch
+        does not exist.
+        """
+
+        try:
+            with open(self.__ref_file) as ref_file:
+                sha = ref_file.read().strip()
+
+            if sha:
+                return sha
+        except (IOError, OSError):
+            pass
+
+        try:
+            with open(self.__packed_refs) as packed_refs:
+                for line in packed_refs:
+                    if line.startswith('#') or line.startswith('^'):
+                        continue
+
+                    parts = line.split()
+
+                    if len(parts) == 2 and parts[1] == self.__ref_name:
+                        return parts[0]
+        except (IOError, OSError):
+            pass
+
+        return None
+
+    def wait(self):
+        """
+        Wait until something changes around the ref, or until the poll
+        interval elapses.
+        """
+
+        if self.__inotify is None:
+            sleep(self.__poll_interval)
+
+            return
+
+        # The branch’s directory may only appear later (e.g. for
+        # feature/xyz branches), so the timeout is kept as a fallback
+        self.__inotify.read(timeout=int(self.__poll_interval * 1000))
+        self.__add_watches()
+
+    def heads(self, stop=None, head=None):
+        """
+        Generate the new SHA1 IDs of the branch whenever it changes,
+        until stop() returns True.  If head is set, changes are
+        reported relative to it (immediately, if the branch has already
+        moved); otherwise relative to the current head.
+        """
+
+        if head is None:
+            head = self.read_head()
+
+        while stop is None or not stop():
+            new_head = self.read_head()
+
+            if new_head is not None and new_head != head:
+                head = new_head
+
+                yield head
+
+                continue
+
+            self.wait()
+
+
+class CommitFollower(object):
+    """
+    Keep track of the head of a branch, and find out which commits are
+    new (or gone) when the branch moves.
+
+    Only the commits between the old and the new head are listed (with
+    git rev-list), so moving the branch never rescans the full history,
+    not even when it merges a branch forked long ago.
+    """
+
+    def __init__(self, repository, head, max_new=None):
+        self.__repo = Repo(repository)
+        self.__max_new = max_new or 500
+        self.__head = head
+
+    def __rev_list(self, head, exclude, max_count=None):
+        """
+        List the SHA1 IDs of the commits reachable from head, but not
+        from exclude.
+        """
+
+        args = [head, '--not', exclude]
+
+        if max_count is not None:
+            args.insert(0, '--max-count={}'.format(max_count))
+
+        return self.__repo.git.rev_list(*args).split()
+
+    def update(self, head):
+        """
+        Process a new head of the branch.
+
+        Returns a tuple of the SHA1 IDs of the commits that are no
+        longer on the branch (after a rewind or force-push), and the
+        new commit objects, sorted by authoring date.  If there are
+        more than max_new new commits (e.g. after a force-push to an
+        unrelated history), only the most recent max_new are returned.
+        """
+
+        old_head = self.__head
+        self.__head = head
+
+        if self.__repo.is_ancestor(old_head, head):
+            dropped = []
+        else:
+            dropped = self.__rev_list(old_head, head)
+
+        new_commits = [self.__repo.commit(sha)
+                       for sha in self.__rev_list(head, old_head,
+                                                  max_count=self.__max_new)]
+        new_commits.sort(key=lambda commit: (commit.authored_date,
+                                             commit.hexsha))
+
+        return dropped, new_commits
+
+
+def follow_branch(midi, repository, branch, on_beat, on_rewind=None,
+                  poll_interval=None, stop=None, head=None):
+    """
+    Follow branch in repository, and call on_beat(beat, record) with
+    the beat generated by midi (a GitMIDI object) and the commit record
+    for every new commit.  If commits disappear from the branch,
+    on_rewind(shas) is called first.  Runs until stop() returns True.
+
+    Commits are new relative to head (a SHA1 ID), e.g. the head the
+    caller has already rendered, so commits arriving in the meantime
+    are not missed.  By default, the current head of branch is used.
+    """
+
+    watcher = RefWatcher(repository, branch, poll_interval=poll_interval)
+
+    if head is None:
+        head = watcher.read_head()
+
+    follower = CommitFollower(repository, head)
+
+    for head in watcher.heads(stop=stop, head=head):
+        dropped, new_commits = follower.update(head)
+
+        if dropped and on_rewind is not None:
+            on_rewind(dropped)
+
+        for commit in new_commits:
+            record = midi.read_commit(commit)
+            on_beat(midi.gen_beat(record), record)